@@ -48,13 +48,15 @@ notes:
 
     matching_notes = notebook.search(query)
 
-This module provides a simple brute force full text search implementation.
+This module provides a simple brute force full text search implementation,
+and a WordIndex whose search method finds the same notes using an index.
 Other modules could provide better search functions that could be plugged in.
 
 """
 import logging
 logger = logging.getLogger(__name__)
 import os
+import sqlite3
 import sys
 
 import chardet
@@ -191,10 +193,19 @@ class PlainTextNote(object):
 
         """
         self._title = title
+        # Cache the lowercased title, it's needed for every search.
+        self._title_lower = title.lower()
         self._notebook = notebook
         self._extension = extension
         self._filename = self.title + self._extension
-        self._abspath = os.path.join(self._notebook.path, self._filename)
+        # Intern the path: it's used as a dict key (e.g. by the user
+        # interface's widget cache) and for comparing notes, and interned
+        # strings can be compared by identity.
+        self._abspath = sys.intern(
+                os.path.join(self._notebook.path, self._filename))
+        # Notes are hashed for every note in every search, and the path
+        # doesn't change, so hash it once.
+        self._hash = hash(self._abspath)
 
         # Create the file's parent directories (including note directory
         # subdirs) if they don't exist.
@@ -219,6 +230,10 @@ class PlainTextNote(object):
         # TODO: Implement note renaming. Should rename file on disk.
         raise NotImplementedError
 
+    @property
+    def title_lower(self):
+        return self._title_lower
+
     @property
     def extension(self):
         return self._extension
@@ -250,6 +265,9 @@ class PlainTextNote(object):
     def __eq__(self, other):
         return getattr(other, 'abspath', None) == self.abspath
 
+    def __hash__(self):
+        return self._hash
+
 
 def brute_force_search(notebook, query):
     """Return all notes in `notebook` that match `query`.
@@ -258,7 +276,7 @@ def brute_force_search(notebook, query):
 
     Arguments:
 
-    notebook - the notebook to search (NoteBook)
+    notebook - the notebook to search (NoteBook, or any sequence of Notes)
 
     query - the query to search for (string)
 
@@ -270,26 +288,239 @@ def brute_force_search(notebook, query):
     in the notebook looking for the search words.
 
     """
-    search_words = query.strip().split()
+    # Decide once per query, not once per note, which words are searched for
+    # case-insensitively.
+    search_words = [(search_word, search_word.islower())
+            for search_word in query.strip().split()]
     matching_notes = []
     for note in notebook:
+        # Read the note's file at most once, and only if a word isn't found
+        # in the title.
+        contents = None
+        contents_lower = None
         match = True
-        for search_word in search_words:
-            if search_word.islower():
+        for search_word, ignore_case in search_words:
+            if ignore_case:
                 # Search for word case-insensitively.
-                in_title = search_word in note.title.lower()
-                in_contents = search_word in note.contents.lower()
+                if search_word in note.title_lower:
+                    continue
+                if contents_lower is None:
+                    if contents is None:
+                        contents = note.contents
+                    contents_lower = contents.lower()
+                in_contents = search_word in contents_lower
             else:
                 # Search for word case-sensitively.
-                in_title = search_word in note.title
-                in_contents = search_word in note.contents
-            if (not in_title) and (not in_contents):
+                if search_word in note.title:
+                    continue
+                if contents is None:
+                    contents = note.contents
+                in_contents = search_word in contents
+            if not in_contents:
                 match = False
+                break
         if match:
             matching_notes.append(note)
     return matching_notes
 
 
+class Vocabulary(object):
+    """A set of words that can be searched for the words containing a string.
+
+    If the sqlite3 module supports SQLite's FTS5 trigram tokenizer, the words
+    are kept in an in-memory trigram index so that searching doesn't have to
+    test every word in Python. Otherwise every word is tested.
+
+    """
+    def __init__(self):
+        self._ids = {}  # Word -> rowid in the words table.
+        self._next_id = 0
+        self._pending = {}  # Word -> True to add it or False to remove it.
+        try:
+            # The index is used from the user interface's search thread.
+            db = sqlite3.connect(":memory:", check_same_thread=False)
+            db.execute("CREATE VIRTUAL TABLE words USING "
+                    "fts5(word, tokenize='trigram case_sensitive 1')")
+        except sqlite3.Error as e:
+            logger.debug(u"No SQLite trigram index, testing every word: "
+                    u"{0}".format(e))
+            db = None
+        self._db = db
+
+    def add(self, word):
+        self._pending[word] = True
+
+    def discard(self, word):
+        self._pending[word] = False
+
+    def _flush(self):
+        """Apply the pending additions and removals in one go."""
+
+        added = []
+        removed = []
+        for word, add in self._pending.items():
+            if add and word not in self._ids:
+                self._ids[word] = self._next_id
+                added.append((self._next_id, word))
+                self._next_id += 1
+            elif not add and word in self._ids:
+                removed.append((self._ids.pop(word),))
+        self._pending = {}
+        if self._db is not None:
+            self._db.executemany(
+                    "INSERT INTO words (rowid, word) VALUES (?, ?)", added)
+            self._db.executemany("DELETE FROM words WHERE rowid = ?", removed)
+
+    def containing(self, string):
+        """Return the words that contain the given string."""
+
+        if self._pending:
+            self._flush()
+        if (self._db is None or len(string) < 3
+                or any(char in string for char in "*?[")):
+            # Trigrams can't help find strings shorter than three characters.
+            # SQLite's trigram GLOB also gets literal runs of under three
+            # non-ASCII characters wrong, so don't search for strings that
+            # would need escaping (and so be split into shorter runs).
+            return [word for word in self._ids if string in word]
+        # GLOB is case-sensitive, like `in`.
+        rows = self._db.execute("SELECT word FROM words WHERE word GLOB ?",
+                ("*" + string + "*",))
+        return [word for word, in rows]
+
+
+class WordIndex(object):
+    """An index of the words in the titles and contents of notes.
+
+    A WordIndex's search() method can be used as a NoteBook's search function
+    in place of brute_force_search(). It returns the same results, but
+    answers queries from the index instead of reading every note file on
+    every search:
+
+        index = WordIndex(notebook)
+        notebook.search_function = index.search
+
+    Words are split on whitespace, as search words are, so a search word
+    appears in a note's title or contents if and only if it is a substring of
+    one of the note's words. A search finds the indexed words that contain
+    each search word (see Vocabulary) and intersects the sets of notes they
+    appear in.
+
+    The index doesn't notice when note files change, call update() after a
+    note has been added or edited.
+
+    """
+    def __init__(self, notes=()):
+        """Make a new WordIndex of the given Notes."""
+
+        self._postings = {}  # Word -> set of notes containing it.
+        self._postings_lower = {}  # Same, for lowercased words.
+        self._vocabulary = Vocabulary()  # The words in _postings.
+        self._vocabulary_lower = Vocabulary()  # The words in _postings_lower.
+        self._words = {}  # Note -> (words, lowercased words).
+        for note in notes:
+            self.update(note)
+
+    def update(self, note):
+        """Add the given Note to the index, or re-index it."""
+
+        self._remove(note)
+        contents = self._read_contents(note)
+        words = set(note.title.split())
+        words.update(contents.split())
+        # Lowercase each text in one call rather than each word separately,
+        # lowercasing never adds or removes whitespace so the words are the
+        # same.
+        words_lower = set(note.title_lower.split())
+        words_lower.update(contents.lower().split())
+        self._words[note] = (words, words_lower)
+        for postings, vocabulary, note_words in (
+                (self._postings, self._vocabulary, words),
+                (self._postings_lower, self._vocabulary_lower, words_lower)):
+            for word in note_words:
+                notes = postings.get(word)
+                if notes is None:
+                    notes = postings[word] = set()
+                    vocabulary.add(word)
+                notes.add(note)
+
+    def _read_contents(self, note):
+        """Return the note's contents, or "" if they can't be read.
+
+        Unlike brute_force_search(), the index reads every note up front, so
+        one unreadable note mustn't stop the rest from being indexed.
+
+        """
+        try:
+            return note.contents
+        except UnicodeDecodeError:
+            pass
+        except (IOError, OSError) as e:
+            logger.error(u"Could not read {0}: {1}".format(note.abspath, e))
+            return ""
+
+        # The file isn't UTF-8, try harder to decode it.
+        try:
+            with open(note.abspath, "rb") as f:
+                contents = unicode_or_bust(f.read())
+        except (IOError, OSError) as e:
+            logger.error(u"Could not read {0}: {1}".format(note.abspath, e))
+            return ""
+        if contents is None:
+            logger.error(
+                u"Could not decode file contents: {0}".format(note.abspath))
+            return ""
+        return contents
+
+    def _remove(self, note):
+        words, words_lower = self._words.pop(note, ((), ()))
+        for postings, vocabulary, note_words in (
+                (self._postings, self._vocabulary, words),
+                (self._postings_lower, self._vocabulary_lower, words_lower)):
+            for word in note_words:
+                notes = postings[word]
+                notes.discard(note)
+                if not notes:
+                    del postings[word]
+                    vocabulary.discard(word)
+
+    def search(self, notebook, query):
+        """Return all notes in `notebook` that match `query`.
+
+        Matches notes exactly as brute_force_search() does, and returns them
+        in the same order. `notebook` may be a NoteBook or any sequence of
+        indexed Notes.
+
+        """
+        matches_per_word = []
+        for search_word in query.strip().split():
+            if search_word.islower():
+                # Search for word case-insensitively.
+                postings = self._postings_lower
+                vocabulary = self._vocabulary_lower
+            else:
+                # Search for word case-sensitively.
+                postings = self._postings
+                vocabulary = self._vocabulary
+            matches = set()
+            for word in vocabulary.containing(search_word):
+                matches.update(postings[word])
+            matches_per_word.append(matches)
+
+        if not matches_per_word:
+            return list(notebook)
+
+        # Intersect the smallest sets first.
+        matches_per_word.sort(key=len)
+        matches = matches_per_word[0]
+        for other_matches in matches_per_word[1:]:
+            if not matches:
+                break
+            matches = matches & other_matches
+
+        return [note for note in notebook if note in matches]
+
+
 class PlainTextNoteBook(object):
     """A NoteBook that stores its notes as a directory of plain text files."""
 
@@ -384,14 +615,18 @@ class PlainTextNoteBook(object):
     def path(self):
         return self._path
 
-    def search(self, query):
+    def search(self, query, notes=None):
         """Return a sequence of Notes that match the given query.
 
         Arguments:
         query -- the search query match notes against (string)
+        notes -- a sequence of this NoteBook's Notes to restrict the search
+            to, e.g. the results of an earlier search (default: all Notes)
 
         """
-        return self.search_function(self, query)
+        if notes is None:
+            notes = self
+        return self.search_function(notes, query)
 
     def add_new(self, title, extension=None):
         """Create a new Note and add it to this NoteBook.
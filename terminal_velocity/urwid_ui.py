@@ -3,10 +3,15 @@
 Implemented using the console user interface library urwid.
 
 """
+import os
 import sys
+import bisect
+import operator
+import queue
 import subprocess
 import shlex
 import logging
+import threading
 import urwid
 from . import notebook
 
@@ -20,21 +25,26 @@ palette = [
     ("autocomplete", "black", "brown"),
 ]
 
+# Seconds to wait after the last change to the search box before filtering,
+# so that a burst of keystrokes causes only one filter.
+FILTER_DELAY = 0.15
 
-def system(cmd, loop):
-    """Execute a system command in a subshell and return the exit status."""
 
-    loop.screen.stop()
+def system(args, loop):
+    """Execute a command and return its exit status.
 
-    cmd = f"{cmd}"
-    cmd = cmd.encode(sys.getfilesystemencoding())  # FIXME: Correct encoding?
+    The command is given as a list of arguments and is run directly, not in
+    a subshell.
 
-    try:
-        if isinstance(cmd, bytes):
-            cmd = cmd.decode('utf-8')
+    """
+    loop.screen.stop()
 
-        # Use shell=True to handle complex commands (like pipes)
-        returncode = subprocess.call(cmd, shell=True)
+    try:
+        returncode = subprocess.call(args)
+    except OSError as e:
+        # E.g. the editor wasn't found, return the exit status a shell would.
+        logger.error("Could not run {0}: {1}".format(args[0], e))
+        returncode = 127
     except Exception as e:
         logger.exception(e)
         raise e
@@ -90,21 +100,56 @@ class AutocompleteWidget(urwid.Edit):
     def __init__(self, *args, **kwargs):
         self.fake_focus = True
         self._autocomplete_text = None
+        self._autocomplete_text_lower = None
+        self._text_cache = None  # ((edit text, autocomplete text), text)
         super().__init__(*args, **kwargs)
 
+    def set_edit_text(self, text):
+        # Cache the lowercased edit text, it's needed on every render. Do it
+        # first, the text may be rendered before set_edit_text() returns.
+        self._edit_text_lower = text.lower()
+        super().set_edit_text(text)
+
+    # urwid.Edit's edit_text property calls Edit.set_edit_text(), rebind it so
+    # that assigning to edit_text updates the lowercased edit text too.
+    edit_text = property(urwid.Edit.get_edit_text, set_edit_text)
+
+    @property
+    def edit_text_lower(self):
+        return self._edit_text_lower
+
     @property
     def autocomplete_text(self):
         return self._autocomplete_text
 
     @autocomplete_text.setter
     def autocomplete_text(self, text):
+        if text == self._autocomplete_text:
+            return
         self._autocomplete_text = text
+        # Cache the lowercased autocomplete text, it's needed on every render.
+        self._autocomplete_text_lower = text.lower() if text else None
+        # urwid.Edit (4.1 and later) keeps the layout of its text until the
+        # edit text changes, so lay out the new text shown. Older urwid
+        # redoes the layout on _invalidate().
+        sync = getattr(self, "_sync_wrapped", None)
+        if sync is not None:
+            sync()
         self._invalidate()
 
     def render(self, size, focus=False):
         return super().render(size, self.fake_focus)
 
     def get_text(self):
+        # urwid calls get_text() several times per render, and again when
+        # handling keys, so cache the text until the edit text or the
+        # autocomplete text changes.
+        key = (self.edit_text, self._autocomplete_text)
+        if self._text_cache is None or self._text_cache[0] != key:
+            self._text_cache = (key, self._get_text())
+        return self._text_cache[1]
+
+    def _get_text(self):
 
         # When search bar is empty show placeholder text.
         if not self.edit_text and not self.autocomplete_text:
@@ -117,17 +162,17 @@ class AutocompleteWidget(urwid.Edit):
             return super().get_text()
 
         # When a note is focused show it's title in the search bar.
-        is_substring = self.autocomplete_text.lower().startswith(
-                self.edit_text.lower())
-        if self.edit_text and is_substring:
+        edit_text = self.edit_text
+        is_substring = self._autocomplete_text_lower.startswith(
+                self._edit_text_lower)
+        if edit_text and is_substring:
             # If the typed text is a substring of the focused note's title,
             # then show the typed text followed by the rest of the focused
             # note's title in a different color.
-            text_to_show = self.edit_text + self.autocomplete_text[
-                    len(self.edit_text):]
-            attrs = [("search", len(self.edit_text)),
-                    ("autocomplete", len(text_to_show) - len(self.edit_text))]
-            return (text_to_show, attrs)
+            edit_len = len(edit_text)
+            rest = self.autocomplete_text[edit_len:]
+            attrs = [("search", edit_len), ("autocomplete", len(rest))]
+            return (edit_text + rest, attrs)
         else:
             # If the typed text is not a prefix of the focused note's title,
             # just show the focused note's title in the search bar.
@@ -147,6 +192,68 @@ class AutocompleteWidget(urwid.Edit):
             return False
 
 
+class NoteListWalker(urwid.ListWalker):
+    """A list walker over a list of notes.
+
+    NoteWidgets are only made for the notes that the list box asks for (the
+    ones on screen), not for every note in the list, and are cached for
+    reuse.
+
+    """
+    def __init__(self):
+        self.notes = []
+        self.focus = 0
+        self.widgets = {}  # NoteWidget cache.
+        self._positions = None  # Position of each note, built when needed.
+
+    def set_notes(self, notes):
+        """Replace the list of notes, and focus the first one."""
+
+        self.notes = notes
+        self.focus = 0
+        self._positions = None
+        self._modified()
+
+    def position_of(self, note):
+        """Return the position of the given note, or None."""
+
+        if self._positions is None:
+            self._positions = {note: position for position, note in
+                    enumerate(self.notes)}
+        return self._positions.get(note)
+
+    def _get_widget(self, position):
+        note = self.notes[position]
+        widget = self.widgets.get(note.abspath)
+        if widget is None:
+            widget = self.widgets[note.abspath] = NoteWidget(note)
+        return widget
+
+    def __len__(self):
+        return len(self.notes)
+
+    def get_focus(self):
+        if not self.notes:
+            return None, None
+        return self._get_widget(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        position += 1
+        if position >= len(self.notes):
+            return None, None
+        return self._get_widget(position), position
+
+    def get_prev(self, position):
+        position -= 1
+        if position < 0:
+            return None, None
+        return self._get_widget(position), position
+
+
 class NoteFilterListBox(urwid.ListBox):
     """A filterable list of notes from a notebook."""
 
@@ -159,8 +266,7 @@ class NoteFilterListBox(urwid.ListBox):
 
         """
         self._fake_focus = False
-        self.list_walker = urwid.SimpleFocusListWalker([])
-        self.widgets = {}  # NoteWidget cache.
+        self.list_walker = NoteListWalker()
         super().__init__(self.list_walker)
         self.on_changed = on_changed
 
@@ -174,6 +280,8 @@ class NoteFilterListBox(urwid.ListBox):
 
     @fake_focus.setter
     def fake_focus(self, value):
+        if value == self._fake_focus:
+            return
         self._fake_focus = value
         self._invalidate()
 
@@ -187,28 +295,14 @@ class NoteFilterListBox(urwid.ListBox):
     def filter(self, matching_notes):
         """Filter this listbox to show only widgets for matching notes."""
 
-        matching_widgets = []
-        for note in matching_notes:
-            widget = self.widgets.get(note.abspath)
-            if widget:
-                matching_widgets.append(widget)
-            else:
-                widget = NoteWidget(note)
-                self.widgets[note.abspath] = widget
-                matching_widgets.append(widget)
-
-        del self.list_walker[:]
-
-        for widget in matching_widgets:
-            self.list_walker.append(widget)
+        self.list_walker.set_notes(matching_notes)
 
     def focus_note(self, note):
         """Focus the widget for the given note."""
 
-        for widget in self.list_walker:
-            if widget.note == note:
-                self.list_walker.set_focus(self.list_walker.index(widget))
-                break
+        position = self.list_walker.position_of(note)
+        if position is not None:
+            self.list_walker.set_focus(position)
 
     def keypress(self, size, key):
         result = super().keypress(size, key)
@@ -227,15 +321,42 @@ class MainFrame(urwid.Frame):
 
     def __init__(self, notes_dir, editor, extension, extensions, exclude=None):
 
-        self.editor = editor
+        # The editor command split into arguments, a note's path is appended.
+        # Raises ValueError if the command can't be split (e.g. if it has
+        # unbalanced quotes).
+        self.editor_args = shlex.split(editor)
         self.notebook = notebook.PlainTextNoteBook(notes_dir, extension,
                 extensions, exclude=exclude)
+        self.word_index = notebook.WordIndex(self.notebook)
+        self.notebook.search_function = self.word_index.search
 
         self.suppress_filter = False
         self.suppress_focus = False
 
         self._selected_note = None
 
+        # The urwid.MainLoop running this frame, set by launch().
+        self.loop = None
+        self._filter_alarm = None
+
+        self._index_notes()
+        self._sort_notes_by_mtime()
+
+        # The last query filtered for and its matching notes, used to narrow
+        # down the next search when the user types more characters.
+        self._last_query = None
+        self._last_matches = None
+
+        # Searches are run in a background thread once start_search_thread()
+        # has been called. Each search request is numbered so that results of
+        # searches that have since been superseded can be discarded.
+        self._search_lock = threading.Lock()
+        self._search_queue = None
+        self._search_pipe = None
+        self._search_number = 0
+        self._shown_search_number = 0  # The number of the results shown.
+        self._search_result = None
+
         self.search_box = AutocompleteWidget(wrap="clip")
         self.list_box = NoteFilterListBox(on_changed=self.on_list_box_changed)
 
@@ -280,6 +401,45 @@ class MainFrame(urwid.Frame):
 
         self._selected_note = note
 
+    def _index_notes(self):
+        """Build the sorted index of lowercased note titles.
+
+        The index is used to find autocompletable notes by binary search
+        instead of testing every matching note's title on each keystroke.
+
+        """
+        self._sorted_notes = sorted(self.notebook,
+                key=lambda note: note.title_lower)
+        self._sorted_keys = [note.title_lower for note in self._sorted_notes]
+
+    def _sort_notes_by_mtime(self):
+        """Sort the notes, most recently modified first.
+
+        Reading a note's mtime means a stat() call, so the notes are sorted
+        once, rather than sorting every search's matches by mtime. Each
+        note's rank is remembered too, for sorting other lists of notes.
+
+        """
+        self._notes_by_mtime = sorted(self.notebook,
+                key=operator.attrgetter("mtime"), reverse=True)
+        self._mtime_rank = {note: rank for rank, note in
+                enumerate(self._notes_by_mtime)}
+
+    def _index_add(self, note):
+        """Add a newly created note to the sorted title index."""
+
+        key = note.title_lower
+        position = bisect.bisect_right(self._sorted_keys, key)
+        self._sorted_keys.insert(position, key)
+        self._sorted_notes.insert(position, note)
+
+    def _prefix_matches(self, prefix):
+        """Return the notes whose lowercased titles start with `prefix`."""
+
+        lo = bisect.bisect_left(self._sorted_keys, prefix)
+        hi = bisect.bisect_left(self._sorted_keys, prefix + chr(sys.maxunicode))
+        return self._sorted_notes[lo:hi]
+
     def quit(self):
         """Quit the app."""
 
@@ -292,6 +452,12 @@ class MainFrame(urwid.Frame):
         self.suppress_filter = False
         self.suppress_focus = False
 
+        # These keys act on the selected note or the list of notes, so make
+        # sure those are up to date with the typed text first.
+        if key in ["esc", "ctrl d", "enter", "tab", "left", "right", "down",
+                "up", "page up", "page down", "backspace"]:
+            self.flush_filter()
+
         if key in ["esc", "ctrl d"]:
             if self.selected_note:
                 self.selected_note = None
@@ -301,16 +467,23 @@ class MainFrame(urwid.Frame):
                 return None
 
         elif key in ["enter"]:
+            edited_note = None
             if self.selected_note:
-                system(self.editor + ' ' + shlex.quote(self.selected_note.abspath), self.loop)
+                edited_note = self.selected_note
+                system(self.editor_args + [self.selected_note.abspath],
+                        self.loop)
             else:
                 if self.search_box.edit_text:
                     try:
-                        note = self.notebook.add_new(self.search_box.edit_text)
-                        system(self.editor + ' ' + shlex.quote(note.abspath), self.loop)
+                        with self._search_lock:
+                            note = self.notebook.add_new(
+                                    self.search_box.edit_text)
+                            self._index_add(note)
+                        edited_note = note
+                        system(self.editor_args + [note.abspath], self.loop)
                     except notebook.NoteAlreadyExistsError:
-                        system(self.editor + ' ' + shlex.quote(self.search_box.edit_text +
-                                self.notebook.extension),
+                        system(self.editor_args + [self.search_box.edit_text +
+                                self.notebook.extension],
                             self.loop)
                     except notebook.InvalidNoteTitleError:
                         pass
@@ -318,6 +491,13 @@ class MainFrame(urwid.Frame):
                     pass
             self.suppress_focus = True
 
+            # The notebook or the note contents may have changed, so the
+            # last matches can't be used to narrow down the next search.
+            with self._search_lock:
+                if edited_note is not None:
+                    self.word_index.update(edited_note)
+                self._last_matches = None
+                self._sort_notes_by_mtime()
 
             self.filter(self.search_box.edit_text)
             return None
@@ -348,8 +528,8 @@ class MainFrame(urwid.Frame):
                 if self.search_box.edit_text == "":
                     consume = True
                 else:
-                    title = self.selected_note.title.lower()
-                    typed = self.search_box.edit_text.lower()
+                    title = self.selected_note.title_lower
+                    typed = self.search_box.edit_text_lower
                     if not title.startswith(typed):
                         consume = True
             if consume:
@@ -368,31 +548,131 @@ class MainFrame(urwid.Frame):
         if self.suppress_filter:
             return
 
+        # A direct filter supersedes any pending debounced one.
+        if self._filter_alarm is not None:
+            self.loop.remove_alarm(self._filter_alarm)
+            self._filter_alarm = None
+
+        # And so do the results of any search still running in the background.
+        self._search_number += 1
+
+        self.show_matches(query, self.search(query))
+        self._shown_search_number = self._search_number
+
+    def search(self, query):
+        """Return the notes matching the given query, most recent first.
+
+        This may be called from the search thread.
+
+        """
+        with self._search_lock:
+            if not query.strip():
+                # Every note matches an empty query.
+                matching_notes = self._notes_by_mtime
+            elif (self._last_matches is not None
+                    and query.startswith(self._last_query)):
+                # Notes matching the extended query are a subset of those that
+                # matched the last one (and are already sorted).
+                matching_notes = self.notebook.search(query,
+                        notes=self._last_matches)
+            else:
+                # Search the notes in mtime order, so that the matches come out
+                # sorted and don't need sorting afterwards.
+                matching_notes = self.notebook.search(query,
+                        notes=self._notes_by_mtime)
+
+            self._last_query = query
+            self._last_matches = matching_notes
+
+        return matching_notes
+
+    def show_matches(self, query, matching_notes):
+        """Show the given search results in the list box and search box."""
+
         if len(self.notebook) == 0:
             self.body = placeholder_text("You have no notes yet, to create "
                 "a note type a note title then press Enter")
         else:
             self.body = urwid.Padding(self.list_box, left=1, right=1)
 
-        matching_notes = self.notebook.search(query)
-
-        matching_notes.sort(key=lambda x: x.mtime, reverse=True)
-
         self.list_box.filter(matching_notes)
 
-        autocompletable_matches = []
+        # Autocomplete the most recently modified matching note whose title
+        # starts with the query. There are usually few notes with the prefix,
+        # so check those (most recent first) rather than all matching notes.
+        autocompletable_match = None
         if query:
-            for note in matching_notes:
-                if note.title.lower().startswith(query.lower()):
-                    autocompletable_matches.append(note)
+            prefixed = self._prefix_matches(query.lower())
+            prefixed.sort(key=self._mtime_rank.__getitem__)
+            for note in prefixed:
+                if self.list_box.list_walker.position_of(note) is not None:
+                    autocompletable_match = note
+                    break
 
-        if autocompletable_matches:
-            self.selected_note = autocompletable_matches[0]
-        else:
-            self.selected_note = None
+        self.selected_note = autocompletable_match
+
+    def flush_filter(self):
+        """Filter now if a filter for the typed text is still pending.
+
+        That is, if the filter is waiting for its alarm or its search is still
+        running in the search thread.
+
+        """
+        if (self._filter_alarm is not None
+                or self._shown_search_number != self._search_number):
+            self.filter(self.search_box.edit_text)
 
     def on_search_box_changed(self, edit, new_edit_text):
-        self.filter(new_edit_text)
+        if self.loop is None:
+            self.filter(new_edit_text)
+            return
+        if self._filter_alarm is not None:
+            self.loop.remove_alarm(self._filter_alarm)
+        self._filter_alarm = self.loop.set_alarm_in(FILTER_DELAY,
+                self.on_filter_alarm)
+
+    def on_filter_alarm(self, loop, user_data):
+        self._filter_alarm = None
+        if self._search_queue is None:
+            self.filter(self.search_box.edit_text)
+            return
+        if self.suppress_filter:
+            return
+        self._search_number += 1
+        self._search_queue.put((self._search_number,
+                self.search_box.edit_text))
+
+    def start_search_thread(self):
+        """Run searches for typed queries in a background thread.
+
+        This keeps the search box responsive while a search is reading
+        note files. Results are passed back to the main loop through a pipe.
+
+        """
+        self._search_queue = queue.Queue()
+        self._search_pipe = self.loop.watch_pipe(self.on_search_result)
+        thread = threading.Thread(target=self._search_thread, daemon=True)
+        thread.start()
+
+    def _search_thread(self):
+        while True:
+            number, query = self._search_queue.get()
+            # Skip straight to the newest query if several are waiting.
+            try:
+                while True:
+                    number, query = self._search_queue.get_nowait()
+            except queue.Empty:
+                pass
+            matching_notes = self.search(query)
+            self._search_result = (number, query, matching_notes)
+            os.write(self._search_pipe, b"\n")
+
+    def on_search_result(self, data):
+        number, query, matching_notes = self._search_result
+        if number == self._search_number:
+            self.show_matches(query, matching_notes)
+            self._shown_search_number = number
+        return True
 
     def on_list_box_changed(self, note):
         self.selected_note = note
@@ -406,4 +686,5 @@ def launch(notes_dir, editor, extension, extensions, exclude=None):
     frame = MainFrame(notes_dir, editor, extension, extensions, exclude=exclude)
     loop = urwid.MainLoop(frame, palette)
     frame.loop = loop
+    frame.start_search_thread()
     loop.run()